@@ -3,20 +3,26 @@ Tax Wizz - Excel to JSON Converter
 Enhanced Flask Application with Backend-Frontend Sync Features
 """
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash, send_from_directory, send_file
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash, send_from_directory, send_file, has_request_context, g
 from werkzeug.utils import secure_filename
 from functools import wraps
 from openpyxl import load_workbook
-from io import BytesIO, StringIO
+from io import StringIO
 import os
+import sys
 import json
+import orjson
 import secrets
 from datetime import datetime, timedelta
 import logging
 import threading
+import queue
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import time
-import hashlib
-from collections import defaultdict
+import zlib
+from collections import OrderedDict, deque
 
 # ============================================
 # CONFIGURATION
@@ -24,6 +30,8 @@ from collections import defaultdict
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
+ALLOWED_EXTENSIONS = frozenset({'xlsx', 'xls', 'xlsm', 'xlsb', 'json'})
+
 # App Configuration
 app.config.update(
     SECRET_KEY=secrets.token_hex(32),
@@ -31,7 +39,7 @@ app.config.update(
     CONVERTED_FOLDER='converted_files',
     TEMPLATE_FOLDER='templates',
     MAX_CONTENT_LENGTH=16 * 1024 * 1024,
-    ALLOWED_EXTENSIONS={'xlsx', 'xls', 'xlsm', 'xlsb', 'json'},
+    ALLOWED_EXTENSIONS=ALLOWED_EXTENSIONS,
     SESSION_PERMANENT=False,
     SESSION_COOKIE_SECURE=False,
     SESSION_COOKIE_HTTPONLY=True,
@@ -39,7 +47,16 @@ app.config.update(
     # New configurations for sync features
     MAX_HISTORY_PER_USER=50,
     AUTO_SAVE_INTERVAL=300,  # 5 minutes
-    BACKUP_RETENTION_DAYS=7
+    BACKUP_RETENTION_DAYS=7,
+    DIR_CACHE_TTL=5,  # seconds
+    MAX_ACTIVE_USERS=10000,
+    CONVERSION_WORKERS=os.cpu_count(),
+    CONVERSION_TIMEOUT=60,  # seconds
+    SYNC_STREAM_HEARTBEAT=30,  # seconds
+    SYNC_STREAM_MAX_AGE=300,  # seconds a stream holds a server thread before the client reconnects
+    SYNC_STREAM_RETRY=5000,  # milliseconds the client waits before reconnecting
+    SERVER_THREADS=8,  # Waitress worker threads
+    SYNC_STREAM_LIMIT=4  # open sync streams at once, leaving the other threads for normal requests
 )
 
 # Create necessary directories
@@ -66,18 +83,145 @@ logger = logging.getLogger(__name__)
 # IN-MEMORY DATA STORES FOR SYNC FEATURES
 # ============================================
 
+class LRUDict:
+    """Thread-safe mapping capped at max_items, evicting the least recently used keys.
+
+    Missing keys are created with default_factory (like defaultdict). Keys for which
+    is_pinned(key) is true are never evicted; on_evict(key, value) is called for the rest.
+    """
+
+    def __init__(self, max_items, default_factory=None, on_evict=None, is_pinned=None):
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.max_items = max_items
+        self.default_factory = default_factory
+        self.on_evict = on_evict
+        self.is_pinned = is_pinned
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+            if self.default_factory is None:
+                raise KeyError(key)
+            value = self._data[key] = self.default_factory()
+            evicted = self._evict()
+        self._notify_evicted(evicted)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            evicted = self._evict()
+        self._notify_evicted(evicted)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def _evict(self):
+        evicted = []
+        # Each key is looked at once at most, so pinned keys cannot loop forever
+        for _ in range(len(self._data)):
+            if len(self._data) <= self.max_items:
+                break
+            key, value = self._data.popitem(last=False)
+            if self.is_pinned and self.is_pinned(key):
+                self._data[key] = value
+                continue
+            evicted.append((key, value))
+        return evicted
+
+    def _notify_evicted(self, evicted):
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+def is_current_user(user_id):
+    """True when user_id belongs to the request being handled"""
+    return has_request_context() and session.get('user_id') == user_id
+
+def flush_user_activities(user_id, user_session):
+    """Append an evicted user's in-memory activities to user_data/<user_id>/activities.ndjson"""
+    activities = user_session.get('activities')
+    if not activities:
+        return
+    try:
+        activity_file = os.path.join('user_data', user_id, 'activities.ndjson')
+        os.makedirs(os.path.dirname(activity_file), exist_ok=True)
+        with open(activity_file, 'a') as f:
+            f.writelines(json.dumps(activity, default=str) + '\n' for activity in activities)
+    except OSError as e:
+        logger.error(f"Failed to flush activities for {user_id}: {str(e)}")
+
 # User sessions with metadata
-USER_SESSIONS = defaultdict(dict)
+USER_SESSIONS = LRUDict(app.config['MAX_ACTIVE_USERS'], dict,
+                        on_evict=flush_user_activities, is_pinned=is_current_user)
 
-# File processing queue
+# Guards USER_SESSIONS[uid]['counters'], which request threads and the preferences writer both update
+COUNTERS_LOCK = threading.Lock()
+
+# File processing queue (futures of conversions currently running in the worker pool)
 PROCESSING_QUEUE = []
 
-# Real-time status updates
-STATUS_UPDATES = defaultdict(list)
+# Process pool for Excel parsing, created on first use so the reloader parent never forks it
+CONVERSION_EXECUTOR = None
+CONVERSION_EXECUTOR_LOCK = threading.Lock()
+
+# Real-time status updates (bounded, oldest entries drop off automatically)
+STATUS_UPDATES = LRUDict(app.config['MAX_ACTIVE_USERS'], lambda: deque(maxlen=20),
+                         is_pinned=is_current_user)
+
+class SyncChannel:
+    """Per-user change counter that sync streams wait on instead of polling"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, seen_version, timeout):
+        """Block until the version differs from seen_version or timeout; return the current version"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != seen_version, timeout=timeout)
+            return self.version
+
+# Change notifications for /api/sync/stream
+SYNC_CHANNELS = LRUDict(app.config['MAX_ACTIVE_USERS'], SyncChannel, is_pinned=is_current_user)
+
+# Each open stream holds a server thread for its whole lifetime, so only this many may be open
+SYNC_STREAM_SLOTS = threading.BoundedSemaphore(app.config['SYNC_STREAM_LIMIT'])
 
 # User preferences store
 USER_PREFERENCES = {}
 
+# User directories already created, so get_user_directory can skip makedirs
+KNOWN_USER_DIRS = set()
+
+# Pending preference writes, persisted by a background thread (latest write per user wins)
+PENDING_PREFERENCES = {}
+PREFERENCES_LOCK = threading.Lock()
+PREFERENCES_WRITE_QUEUE = queue.Queue()
+
 # Conversion templates
 CONVERSION_TEMPLATES = {
     'default': {
@@ -133,6 +277,11 @@ USERS = {
 # HELPER FUNCTIONS (Enhanced)
 # ============================================
 
+@app.before_request
+def stamp_request_time():
+    """Format the current time once per request; helpers share it via g.now_iso"""
+    g.now_iso = datetime.now().isoformat()
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -156,34 +305,68 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def json_response(data, status=200):
+    """JSON response encoded with orjson, for the frequently polled endpoints"""
+    try:
+        body = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # orjson rejects some valid JSON values (e.g. integers beyond 64 bits); stdlib json does not
+        return jsonify(data), status
+    return app.response_class(body, status=status, mimetype='application/json')
+
 def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+    _, sep, ext = filename.rpartition('.')
+    return bool(sep) and ext.lower() in ALLOWED_EXTENSIONS
 
 def num(value):
+    # openpyxl returns float/int/None for numeric cells, so check those by exact type first
+    if value is None:
+        return 0.0
+    value_type = type(value)
+    if value_type is float:
+        return value
+    if value_type is int:
+        return float(value)
     try:
-        if value is None:
-            return 0.0
-        if isinstance(value, str):
+        if value_type is str:
             cleaned = value.replace(",", "").strip()
             return float(cleaned) if cleaned else 0.0
         return float(value)
     except (ValueError, TypeError):
         return 0.0
 
-def read_excel_data(sheet, start_row, end_row):
+def read_excel_data(sheet, *row_ranges):
+    """Read several (start_row, end_row) trade ranges in a single pass over the sheet.
+
+    Returns a (trades, totals) pair per range, in the order the ranges were given.
+    """
+    first_row = min(start for start, _ in row_ranges)
+    last_row = max(end for _, end in row_ranges)
+    # Read-only sheets are streamed, so this stops parsing at last_row
+    rows = list(sheet.iter_rows(min_row=first_row, max_row=last_row,
+                                min_col=1, max_col=5, values_only=True))
+    return [parse_trade_rows(rows[start - first_row:end - first_row + 1])
+            for start, end in row_ranges]
+
+def parse_trade_rows(rows):
+    """Turn (symbol, qty, buy, sell, pnl) tuples into trades with running P&L/sell totals"""
     data = []
-    for row in range(start_row, end_row + 1):
-        symbol = sheet.cell(row=row, column=1).value
+    # Start from int 0 like sum(), so an empty range still totals 0 rather than 0.0
+    totals = {'pnl': 0, 'sell': 0}
+    for symbol, qty, buy, sell, pnl in rows:
         if symbol and str(symbol).strip():
+            sell_value = num(sell)
+            realized_pnl = num(pnl)
             data.append({
                 "Symbol": str(symbol).strip(),
-                "Quantity": num(sheet.cell(row=row, column=2).value),
-                "Buy Value": num(sheet.cell(row=row, column=3).value),
-                "Sell Value": num(sheet.cell(row=row, column=4).value),
-                "Realized P&L": num(sheet.cell(row=row, column=5).value),
+                "Quantity": num(qty),
+                "Buy Value": num(buy),
+                "Sell Value": sell_value,
+                "Realized P&L": realized_pnl,
             })
-    return data
+            totals['pnl'] += realized_pnl
+            totals['sell'] += sell_value
+    return data, totals
 
 def generate_output_filename(original_filename, user_id):
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -198,51 +381,153 @@ def validate_excel_structure(sheet):
 def get_user_directory(user_id):
     """Get or create user-specific directory"""
     user_dir = os.path.join('user_data', user_id)
-    os.makedirs(user_dir, exist_ok=True)
+    if user_dir not in KNOWN_USER_DIRS:
+        os.makedirs(user_dir, exist_ok=True)
+        KNOWN_USER_DIRS.add(user_dir)
     return user_dir
 
+def scan_user_directory(user_id):
+    """List (filename, stat) for files in the user directory, cached for a few seconds"""
+    now = time.monotonic()
+    cached = USER_SESSIONS[user_id].get('_dir_cache')
+    if cached and now - cached[0] < app.config['DIR_CACHE_TTL']:
+        return cached[1]
+    
+    with os.scandir(get_user_directory(user_id)) as it:
+        entries = [(entry.name, entry.stat()) for entry in it if entry.is_file()]
+    
+    USER_SESSIONS[user_id]['_dir_cache'] = (now, entries)
+    return entries
+
+def invalidate_user_dir_cache(user_id):
+    """Drop the cached directory listing after writing to the user directory"""
+    USER_SESSIONS[user_id].pop('_dir_cache', None)
+
+def get_user_counters(user_id):
+    """Snapshot of the running per-user totals for stats, seeded from a directory scan when missing"""
+    with COUNTERS_LOCK:
+        counters = USER_SESSIONS[user_id].setdefault('counters', {'conversions': 0, 'last_conversion': None})
+        if 'files' not in counters:
+            entries = scan_user_directory(user_id)
+            counters['files'] = len(entries)
+            counters['bytes'] = sum(stat.st_size for _, stat in entries)
+        return dict(counters)
+
+def record_conversion(user_id):
+    """Update running totals after a conversion output has been written"""
+    with COUNTERS_LOCK:
+        counters = USER_SESSIONS[user_id].setdefault('counters', {'conversions': 0, 'last_conversion': None})
+        counters['conversions'] += 1
+        counters['last_conversion'] = g.now_iso
+        # The output may have replaced a same-second file, so re-seed file totals from disk
+        counters.pop('files', None)
+        counters.pop('bytes', None)
+
+def get_conversion_executor():
+    """Get or create the process pool used for Excel parsing"""
+    global CONVERSION_EXECUTOR
+    with CONVERSION_EXECUTOR_LOCK:
+        if CONVERSION_EXECUTOR is None:
+            CONVERSION_EXECUTOR = ProcessPoolExecutor(max_workers=app.config['CONVERSION_WORKERS'])
+        return CONVERSION_EXECUTOR
+
+def reset_conversion_executor(executor):
+    """Drop a broken process pool so the next conversion starts a fresh one"""
+    global CONVERSION_EXECUTOR
+    with CONVERSION_EXECUTOR_LOCK:
+        if CONVERSION_EXECUTOR is executor:
+            CONVERSION_EXECUTOR = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def submit_conversion(*args):
+    """Submit a parse job, recreating the pool once if a worker died since the last job"""
+    executor = get_conversion_executor()
+    try:
+        return executor, executor.submit(parse_and_build, *args)
+    except BrokenProcessPool:
+        logger.warning("Conversion pool was broken, starting a new one")
+        reset_conversion_executor(executor)
+        executor = get_conversion_executor()
+        return executor, executor.submit(parse_and_build, *args)
+
+def remove_upload(workbook_path):
+    """Delete a temp upload, logging instead of raising if it is already gone or locked"""
+    try:
+        os.remove(workbook_path)
+    except OSError as e:
+        logger.warning(f"Could not remove temp upload {workbook_path}: {str(e)}")
+
+def run_conversion(file, template):
+    """Save the upload to a temp file and parse it in the worker pool, waiting for the result"""
+    _, ext = os.path.splitext(secure_filename(file.filename))
+    fd, workbook_path = tempfile.mkstemp(suffix=ext, dir=app.config['UPLOAD_FOLDER'])
+    os.close(fd)
+    future = None
+    try:
+        file.save(workbook_path)
+        executor, future = submit_conversion(workbook_path, template, g.now_iso)
+        PROCESSING_QUEUE.append(future)
+        timeout = app.config['CONVERSION_TIMEOUT']
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning(f"Conversion of {workbook_path} timed out after {timeout} seconds")
+            return {'error': f'Conversion timed out after {timeout} seconds', 'status': 504}
+        except BrokenProcessPool:
+            logger.error(f"Conversion worker crashed while parsing {workbook_path}")
+            reset_conversion_executor(executor)
+            return {'error': 'Conversion worker crashed, please try again', 'status': 500}
+        finally:
+            PROCESSING_QUEUE.remove(future)
+    finally:
+        # A timed-out job may still be reading the file; delete it once the worker is done with it
+        if future is None:
+            remove_upload(workbook_path)
+        else:
+            future.add_done_callback(lambda _: remove_upload(workbook_path))
+
 def log_activity(user_id, activity_type, details):
     """Log user activity for sync and analytics"""
     activity = {
-        'timestamp': datetime.now().isoformat(),
+        'timestamp': g.now_iso,
         'user_id': user_id,
-        'activity_type': activity_type,
+        'activity_type': sys.intern(activity_type),
         'details': details,
         'ip_address': request.remote_addr
     }
     
-    # Store in user session
+    # Store in user session, keeping only the 100 most recent activities
     if 'activities' not in USER_SESSIONS[user_id]:
-        USER_SESSIONS[user_id]['activities'] = []
+        USER_SESSIONS[user_id]['activities'] = deque(maxlen=100)
     
     USER_SESSIONS[user_id]['activities'].append(activity)
-    
-    # Keep only recent activities
-    if len(USER_SESSIONS[user_id]['activities']) > 100:
-        USER_SESSIONS[user_id]['activities'] = USER_SESSIONS[user_id]['activities'][-100:]
+    SYNC_CHANNELS[user_id].notify()
     
     logger.info(f"Activity: {user_id} - {activity_type}")
 
 def update_user_status(user_id, status, message=""):
     """Update real-time user status for frontend sync"""
     status_update = {
-        'timestamp': datetime.now().isoformat(),
-        'status': status,
+        'timestamp': g.now_iso,
+        'status': sys.intern(status),
         'message': message
     }
     
     STATUS_UPDATES[user_id].append(status_update)
-    
-    # Keep only recent status updates
-    if len(STATUS_UPDATES[user_id]) > 20:
-        STATUS_UPDATES[user_id] = STATUS_UPDATES[user_id][-20:]
+    SYNC_CHANNELS[user_id].notify()
+
+def record_conversion_error(user_id, error):
+    """Log a failed conversion and make it the user's latest status"""
+    log_activity(user_id, 'error_occurred', {'error': error})
+    update_user_status(user_id, 'error', error)
 
 def save_user_preferences(user_id, preferences):
-    """Save user preferences to disk"""
-    user_pref_file = os.path.join(get_user_directory(user_id), 'preferences.json')
+    """Save user preferences, queueing the disk write for the background writer"""
     USER_PREFERENCES[user_id] = preferences
-    with open(user_pref_file, 'w') as f:
-        json.dump(preferences, f, indent=2)
+    with PREFERENCES_LOCK:
+        PENDING_PREFERENCES[user_id] = preferences
+    PREFERENCES_WRITE_QUEUE.put(user_id)
 
 def load_user_preferences(user_id):
     """Load user preferences from disk"""
@@ -273,23 +558,62 @@ def home():
 def sync_status():
     """Get real-time sync status for the user"""
     user_id = session.get('user_id')
-    last_sync = USER_SESSIONS[user_id].get('last_sync', datetime.now().isoformat())
+    return json_response(sync_snapshot(user_id, g.now_iso))
+
+@app.route('/api/sync/stream')
+@login_required
+def sync_stream():
+    """Push sync status as Server-Sent Events whenever the user's status or activity changes"""
+    if not SYNC_STREAM_SLOTS.acquire(blocking=False):
+        # EventSource stops retrying on a non-200 answer, so the client falls back to polling /api/sync/status
+        return json_response({'error': 'Too many open sync streams, use /api/sync/status'}, 503)
+    user_id = session.get('user_id')
+    channel = SYNC_CHANNELS[user_id]
+    heartbeat = app.config['SYNC_STREAM_HEARTBEAT']
+    deadline = time.monotonic() + app.config['SYNC_STREAM_MAX_AGE']
     
-    return jsonify({
+    def generate():
+        # Each open stream occupies a server thread, so end it after a while and let EventSource reconnect
+        yield f"retry: {app.config['SYNC_STREAM_RETRY']}\n\n"
+        seen_version = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            version = channel.wait(seen_version, min(heartbeat, remaining))
+            if version == seen_version:
+                yield ': heartbeat\n\n'
+                continue
+            seen_version = version
+            snapshot = sync_snapshot(user_id, datetime.now().isoformat())
+            updates = STATUS_UPDATES.get(user_id)
+            snapshot['latest_update'] = updates[-1] if updates else None
+            yield f"data: {orjson.dumps(snapshot).decode()}\n\n"
+    
+    response = app.response_class(generate(), mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Released when the server closes the response, even if the generator never started
+    response.call_on_close(SYNC_STREAM_SLOTS.release)
+    return response
+
+def sync_snapshot(user_id, now_iso):
+    """Current sync status for a user, shared by the polling and streaming endpoints"""
+    user_session = USER_SESSIONS.get(user_id, {})
+    return {
         'online': True,
-        'last_sync': last_sync,
+        'last_sync': user_session.get('last_sync', now_iso),
         'pending_operations': len(PROCESSING_QUEUE),
-        'user_status': USER_SESSIONS[user_id].get('status', 'idle')
-    })
+        'user_status': user_session.get('status', 'idle')
+    }
 
 @app.route('/api/sync/history')
 @login_required
 def sync_history():
     """Get user activity history for sync"""
     user_id = session.get('user_id')
-    activities = USER_SESSIONS.get(user_id, {}).get('activities', [])
+    activities = list(USER_SESSIONS.get(user_id, {}).get('activities', ()))
     
-    return jsonify({
+    return json_response({
         'activities': activities[-20:],  # Last 20 activities
         'total_count': len(activities)
     })
@@ -299,22 +623,18 @@ def sync_history():
 def recent_files():
     """Get recent files for the user"""
     user_id = session.get('user_id')
-    user_dir = get_user_directory(user_id)
     
     recent_files = []
-    if os.path.exists(user_dir):
-        for filename in os.listdir(user_dir):
-            if filename.endswith('.json'):
-                filepath = os.path.join(user_dir, filename)
-                stat = os.stat(filepath)
-                recent_files.append({
-                    'filename': filename,
-                    'size': stat.st_size,
-                    'modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                    'type': 'json'
-                })
-    
-    return jsonify({'files': sorted(recent_files, key=lambda x: x['modified'], reverse=True)[:10]})
+    for filename, stat in scan_user_directory(user_id):
+        if filename.endswith('.json'):
+            recent_files.append({
+                'filename': filename,
+                'size': stat.st_size,
+                'modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
+                'type': 'json'
+            })
+    
+    return json_response({'files': sorted(recent_files, key=lambda x: x['modified'], reverse=True)[:10]})
 
 @app.route('/api/preferences', methods=['GET', 'POST', 'PUT'])
 @login_required
@@ -362,12 +682,8 @@ def custom_convert():
         
         update_user_status(user_id, 'processing', 'Starting custom conversion')
         
-        # Get template
-        template = CONVERSION_TEMPLATES.get(template_name, CONVERSION_TEMPLATES['default'])
-        
-        # Apply custom parameters
-        if custom_params:
-            template.update(custom_params)
+        # Get template as a fresh copy with custom parameters applied, leaving the shared template untouched
+        template = {**CONVERSION_TEMPLATES.get(template_name, CONVERSION_TEMPLATES['default']), **(custom_params or {})}
         
         # Process file with template
         if 'file' not in request.files:
@@ -380,28 +696,26 @@ def custom_convert():
         if not allowed_file(file.filename):
             return jsonify({'success': False, 'error': 'Invalid file type'}), 400
         
-        # Process with template parameters
-        workbook = load_workbook(filename=BytesIO(file.read()), data_only=True, read_only=True)
-        sheet = workbook.active
-        
-        intraday = read_excel_data(sheet, template['intraday_start'], template['intraday_end'])
-        long_term = read_excel_data(sheet, template['longterm_start'], template['longterm_end'])
+        # Process with template parameters in the worker pool
+        result = run_conversion(file, template)
+        if 'error' in result:
+            if 'status' in result:
+                # Timeouts and worker crashes, recorded like any other failed conversion
+                record_conversion_error(user_id, result['error'])
+            return jsonify({'success': False, 'error': result['error']}), result.get('status', 400)
         
-        # Generate output based on template format
-        if template['output_format'] == 'compact':
-            output_data = generate_compact_output(intraday, long_term)
-        else:
-            output_data = generate_standard_output(intraday, long_term)
-        
-        workbook.close()
+        output_data = result['data']
         
         # Save to user directory
         output_filename = generate_output_filename(file.filename, user_id)
         user_dir = get_user_directory(user_id)
         output_path = os.path.join(user_dir, output_filename)
         
-        with open(output_path, 'w') as f:
-            json.dump(output_data, f, indent=2)
+        payload = orjson.dumps(output_data)
+        with open(output_path, 'wb') as f:
+            f.write(payload)
+        invalidate_user_dir_cache(user_id)
+        record_conversion(user_id)
         
         log_activity(user_id, 'conversion_completed', {
             'template': template_name,
@@ -443,26 +757,26 @@ def create_backup():
     user_id = session.get('user_id')
     user_dir = get_user_directory(user_id)
     
-    # Create backup zip
+    # Create backup zip (the user directory is flat; JSON entries are stored, not deflated)
     import zipfile
-    from io import BytesIO
     
-    memory_file = BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for root, dirs, files in os.walk(user_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, user_dir)
-                zf.write(file_path, arcname)
+    backup_file = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    with zipfile.ZipFile(backup_file, 'w', zipfile.ZIP_STORED) as zf:
+        with os.scandir(user_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    zf.write(entry.path, entry.name)
     
-    memory_file.seek(0)
+    backup_size = backup_file.tell()
+    backup_file.seek(0)
     
-    log_activity(user_id, 'backup_created', {'backup_size': memory_file.getbuffer().nbytes})
+    log_activity(user_id, 'backup_created', {'backup_size': backup_size})
     
     return send_file(
-        memory_file,
+        backup_file,
         download_name=f'{user_id}_backup_{datetime.now().strftime("%Y%m%d")}.zip',
-        as_attachment=True
+        as_attachment=True,
+        mimetype='application/zip'
     )
 
 @app.route('/api/notifications')
@@ -473,45 +787,34 @@ def get_notifications():
     
     # Generate notifications based on activities
     notifications = []
-    activities = USER_SESSIONS.get(user_id, {}).get('activities', [])
+    activities = list(USER_SESSIONS.get(user_id, {}).get('activities', ()))
     
     for activity in activities[-10:]:  # Last 10 activities
         if activity['activity_type'] in ['conversion_completed', 'file_downloaded', 'error_occurred']:
+            id_key = f"{activity['timestamp']}|{activity['activity_type']}|{activity['user_id']}"
             notifications.append({
-                'id': hashlib.md5(json.dumps(activity).encode()).hexdigest()[:8],
+                'id': f"{zlib.crc32(id_key.encode()):08x}",
                 'type': activity['activity_type'],
                 'message': f"{activity['activity_type'].replace('_', ' ').title()}: {activity.get('details', {}).get('filename', '')}",
                 'timestamp': activity['timestamp'],
                 'read': False
             })
     
-    return jsonify({'notifications': notifications})
+    return json_response({'notifications': notifications})
 
 @app.route('/api/stats')
 @login_required
 def user_stats():
     """Get user statistics"""
     user_id = session.get('user_id')
-    user_dir = get_user_directory(user_id)
-    
-    total_files = 0
-    total_size = 0
-    if os.path.exists(user_dir):
-        for root, dirs, files in os.walk(user_dir):
-            total_files += len(files)
-            for file in files:
-                filepath = os.path.join(root, file)
-                total_size += os.path.getsize(filepath)
+    counters = get_user_counters(user_id)
     
-    activities = USER_SESSIONS.get(user_id, {}).get('activities', [])
-    conversions = [a for a in activities if a['activity_type'] == 'conversion_completed']
-    
-    return jsonify({
-        'total_files': total_files,
-        'total_size': total_size,
-        'total_conversions': len(conversions),
-        'last_conversion': conversions[-1]['timestamp'] if conversions else None,
-        'active_since': USER_SESSIONS[user_id].get('login_time', datetime.now().isoformat())
+    return json_response({
+        'total_files': counters['files'],
+        'total_size': counters['bytes'],
+        'total_conversions': counters['conversions'],
+        'last_conversion': counters['last_conversion'],
+        'active_since': USER_SESSIONS[user_id].get('login_time', g.now_iso)
     })
 
 @app.route('/api/validate/json', methods=['POST'])
@@ -574,11 +877,12 @@ def login():
             
             # Initialize user session
             USER_SESSIONS[username] = {
-                'login_time': datetime.now().isoformat(),
+                'login_time': g.now_iso,
                 'ip_address': request.remote_addr,
                 'status': 'active',
-                'last_sync': datetime.now().isoformat()
+                'last_sync': g.now_iso
             }
+            get_user_counters(username)
             
             log_activity(username, 'login', {'ip': request.remote_addr})
             
@@ -618,40 +922,37 @@ def convert():
         update_user_status(user_id, 'processing', 'Reading Excel file')
         log_activity(user_id, 'file_uploaded', {'filename': filename})
         
-        # Process file
-        workbook = load_workbook(filename=BytesIO(file.read()), data_only=True, read_only=True)
-        sheet = workbook.active
-        
-        is_valid, validation_message = validate_excel_structure(sheet)
-        if not is_valid:
-            workbook.close()
-            return jsonify({'success': False, 'error': validation_message}), 400
-        
+        # Read data and generate output in the worker pool
         update_user_status(user_id, 'processing', 'Extracting data')
+        result = run_conversion(file, CONVERSION_TEMPLATES['default'])
+        if 'error' in result:
+            if 'status' in result:
+                # Timeouts and worker crashes, recorded like any other failed conversion
+                record_conversion_error(user_id, result['error'])
+            return jsonify({'success': False, 'error': result['error']}), result.get('status', 400)
         
-        # Read data
-        intraday = read_excel_data(sheet, 42, 42)
-        long_term = read_excel_data(sheet, 55, 57)
-        
-        # Generate output
-        update_user_status(user_id, 'processing', 'Generating JSON output')
-        response_data = generate_standard_output(intraday, long_term)
+        response_data = result['data']
+        intraday_count = result['intraday_count']
+        longterm_count = result['longterm_count']
         
-        workbook.close()
+        update_user_status(user_id, 'processing', 'Saving JSON output')
         
         # Save to user directory
         output_filename = generate_output_filename(filename, user_id)
         user_dir = get_user_directory(user_id)
         output_path = os.path.join(user_dir, output_filename)
         
-        with open(output_path, 'w') as f:
-            json.dump(response_data, f, indent=2)
+        payload = orjson.dumps(response_data)
+        with open(output_path, 'wb') as f:
+            f.write(payload)
+        invalidate_user_dir_cache(user_id)
+        record_conversion(user_id)
         
         log_activity(user_id, 'conversion_completed', {
             'filename': filename,
             'output_file': output_filename,
-            'intraday_count': len(intraday),
-            'longterm_count': len(long_term)
+            'intraday_count': intraday_count,
+            'longterm_count': longterm_count
         })
         
         update_user_status(user_id, 'completed', 'Conversion successful')
@@ -663,16 +964,14 @@ def convert():
             'output_file': output_filename,
             'download_url': f'/api/download/{output_filename}',
             'stats': {
-                'intraday_trades': len(intraday),
-                'long_term_trades': len(long_term)
+                'intraday_trades': intraday_count,
+                'long_term_trades': longterm_count
             }
         })
         
     except Exception as e:
         logger.error(f"Conversion error: {str(e)}")
-        user_id = session.get('user_id')
-        log_activity(user_id, 'error_occurred', {'error': str(e)})
-        update_user_status(user_id, 'error', str(e))
+        record_conversion_error(session.get('user_id'), str(e))
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/index')
@@ -685,7 +984,7 @@ def index():
     preferences = load_user_preferences(user_id)
     
     # Get recent activities
-    activities = USER_SESSIONS.get(user_id, {}).get('activities', [])[-5:]
+    activities = list(USER_SESSIONS.get(user_id, {}).get('activities', ()))[-5:]
     
     # Get user stats
     user_dir = get_user_directory(user_id)
@@ -711,7 +1010,24 @@ def index():
 # HELPER FUNCTIONS FOR OUTPUT GENERATION
 # ============================================
 
-def generate_standard_output(intraday, long_term):
+# Long-term asset row with the constant fields filled in; key order matches the output schema
+LONG_TERM_ROW_TEMPLATE = {
+    "srn": None,
+    "gainType": "LONG",
+    "sellDate": "2025-03-31T18:30:00Z",
+    "purchaseDate": "2024-04-01T18:30:00Z",
+    "sellValue": None,
+    "purchaseCost": None,
+    "sellValuePerUnit": None,
+    "purchaseValuePerUnit": None,
+    "sellOrBuyQuantity": None,
+    "nameOfTheUnits": None,
+    "capitalGain": None,
+    "algorithm": "cgSharesMF",
+    "brokerName": "Manual"
+}
+
+def generate_standard_output(intraday, long_term, intraday_totals, long_term_totals, generated_at):
     """Generate standard output format"""
     capital_gain = []
     if long_term:
@@ -721,21 +1037,18 @@ def generate_standard_output(intraday, long_term):
             sell_value_per_unit = trade["Sell Value"] / qty if qty else 0
             purchase_value_per_unit = trade["Buy Value"] / qty if qty else 0
             
-            asset_details.append({
-                "srn": srn,
-                "gainType": "LONG",
-                "sellDate": "2025-03-31T18:30:00Z",
-                "purchaseDate": "2024-04-01T18:30:00Z",
-                "sellValue": trade["Sell Value"],
-                "purchaseCost": trade["Buy Value"],
-                "sellValuePerUnit": sell_value_per_unit,
-                "purchaseValuePerUnit": purchase_value_per_unit,
-                "sellOrBuyQuantity": qty,
-                "nameOfTheUnits": trade["Symbol"],
-                "capitalGain": trade["Realized P&L"],
-                "algorithm": "cgSharesMF",
-                "brokerName": "Manual"
-            })
+            row = LONG_TERM_ROW_TEMPLATE.copy()
+            row.update(
+                srn=srn,
+                sellValue=trade["Sell Value"],
+                purchaseCost=trade["Buy Value"],
+                sellValuePerUnit=sell_value_per_unit,
+                purchaseValuePerUnit=purchase_value_per_unit,
+                sellOrBuyQuantity=qty,
+                nameOfTheUnits=trade["Symbol"],
+                capitalGain=trade["Realized P&L"]
+            )
+            asset_details.append(row)
         
         capital_gain.append({
             "assessmentYear": "2025-2026",
@@ -746,8 +1059,8 @@ def generate_standard_output(intraday, long_term):
     
     profit_loss = []
     if intraday:
-        total_pnl = sum(t["Realized P&L"] for t in intraday)
-        total_turnover = sum(t["Sell Value"] for t in intraday)
+        total_pnl = intraday_totals['pnl']
+        total_turnover = intraday_totals['sell']
         
         profit_loss.append({
             "businessType": "SPECULATIVEINCOME",
@@ -765,21 +1078,21 @@ def generate_standard_output(intraday, long_term):
         "capitalGain": capital_gain,
         "profitLossACIncomes": profit_loss,
         "metadata": {
-            "generated_at": datetime.now().isoformat(),
+            "generated_at": generated_at,
             "version": "2.0",
             "format": "standard"
         }
     }
 
-def generate_compact_output(intraday, long_term):
+def generate_compact_output(intraday, long_term, intraday_totals, long_term_totals, generated_at):
     """Generate compact output format"""
     output = {
         "summary": {
             "intraday_trades": len(intraday),
             "long_term_trades": len(long_term),
-            "total_intraday_pnl": sum(t["Realized P&L"] for t in intraday),
-            "total_longterm_pnl": sum(t["Realized P&L"] for t in long_term),
-            "generated_at": datetime.now().isoformat()
+            "total_intraday_pnl": intraday_totals['pnl'],
+            "total_longterm_pnl": long_term_totals['pnl'],
+            "generated_at": generated_at
         },
         "trades": {
             "intraday": intraday,
@@ -788,10 +1101,71 @@ def generate_compact_output(intraday, long_term):
     }
     return output
 
+def parse_and_build(workbook_path, template, generated_at):
+    """Parse a saved workbook and build its output; runs in the conversion worker pool"""
+    workbook = load_workbook(workbook_path, data_only=True, read_only=True)
+    try:
+        sheet = workbook.active
+        
+        is_valid, validation_message = validate_excel_structure(sheet)
+        if not is_valid:
+            return {'error': validation_message}
+        
+        (intraday, intraday_totals), (long_term, long_term_totals) = read_excel_data(
+            sheet,
+            (template['intraday_start'], template['intraday_end']),
+            (template['longterm_start'], template['longterm_end'])
+        )
+    finally:
+        workbook.close()
+    
+    if template['output_format'] == 'compact':
+        output_data = generate_compact_output(intraday, long_term, intraday_totals, long_term_totals, generated_at)
+    else:
+        output_data = generate_standard_output(intraday, long_term, intraday_totals, long_term_totals, generated_at)
+    
+    return {
+        'data': output_data,
+        'intraday_count': len(intraday),
+        'longterm_count': len(long_term)
+    }
+
 # ============================================
 # BACKGROUND TASKS (Threading)
 # ============================================
 
+def preferences_writer():
+    """Persist queued user preferences to disk off the request thread"""
+    while True:
+        user_id = PREFERENCES_WRITE_QUEUE.get()
+        with PREFERENCES_LOCK:
+            preferences = PENDING_PREFERENCES.pop(user_id, None)
+        if preferences is None:
+            continue  # Already written by an earlier queue entry
+        
+        try:
+            user_pref_file = os.path.join(get_user_directory(user_id), 'preferences.json')
+            tmp_file = user_pref_file + '.tmp'
+            # Preferences are arbitrary client JSON, which stdlib json can always re-encode
+            with open(tmp_file, 'w') as f:
+                json.dump(preferences, f, separators=(',', ':'))
+            os.replace(tmp_file, user_pref_file)
+        except Exception as e:
+            # Never let one bad entry stop the writer thread
+            logger.error(f"Failed to save preferences for {user_id}: {str(e)}")
+            continue
+        
+        user_session = USER_SESSIONS.get(user_id)
+        if user_session:
+            user_session.pop('_dir_cache', None)
+            # File totals are re-seeded from disk on the next stats request
+            with COUNTERS_LOCK:
+                counters = user_session.get('counters', {})
+                counters.pop('files', None)
+                counters.pop('bytes', None)
+
+threading.Thread(target=preferences_writer, name='preferences-writer', daemon=True).start()
+
 @app.errorhandler(404)
 def page_not_found(e):
     """Handle 404 errors"""
@@ -840,7 +1214,7 @@ def health_check():
     """Health check endpoint for monitoring"""
     return jsonify({
         'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
+        'timestamp': g.now_iso,
         'version': '1.0.0'
     })
 
@@ -854,27 +1228,38 @@ def favicon():
 # APPLICATION STARTUP
 # ============================================
 
+STARTUP_BANNER = "\n".join([
+    "=" * 60,
+    "🚀 TAX WIZZ - Enhanced Excel to JSON Converter",
+    "=" * 60,
+    "📁 User data folder: user_data/",
+    "📁 Upload folder: uploads/",
+    "📁 Converted files: converted_files/",
+    "=" * 60,
+    "🔄 Sync Features Enabled:",
+    "   • Real-time status updates",
+    "   • User activity tracking",
+    "   • File history management",
+    "   • User preferences sync",
+    "   • Automatic cleanup",
+    "=" * 60,
+    "🌐 Server starting on: http://localhost:5000",
+    "=" * 60,
+])
+
 if __name__ == '__main__':
-    print("=" * 60)
-    print("🚀 TAX WIZZ - Enhanced Excel to JSON Converter")
-    print("=" * 60)
-    print("📁 User data folder: user_data/")
-    print("📁 Upload folder: uploads/")
-    print("📁 Converted files: converted_files/")
-    print("=" * 60)
-    print("🔄 Sync Features Enabled:")
-    print("   • Real-time status updates")
-    print("   • User activity tracking")
-    print("   • File history management")
-    print("   • User preferences sync")
-    print("   • Automatic cleanup")
-    print("=" * 60)
-    print(f"🌐 Server starting on: http://localhost:5000")
-    print("=" * 60)
-    
-    app.run(
-        host='0.0.0.0',
-        port=5000,
-        debug=True,
-        use_reloader=True
-    )
\ No newline at end of file
+    sys.stdout.write(STARTUP_BANNER + "\n")
+    
+    from flask.helpers import get_debug_flag
+    
+    if get_debug_flag():
+        # Development: Werkzeug server with debugger and reloader
+        app.run(
+            host='0.0.0.0',
+            port=5000,
+            debug=True,
+            use_reloader=True
+        )
+    else:
+        from waitress import serve
+        serve(app, host='0.0.0.0', port=5000, threads=app.config['SERVER_THREADS'])
\ No newline at end of file
@@ -1,54 +1,374 @@
-from openpyxl import load_workbook
-import json
+from python_calamine import CalamineWorkbook
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict
+from fastnumbers import try_float
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601
+from xml.etree import ElementTree
+import functools
+import mmap
+import orjson
 import os
+import threading
+import zipfile
+
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# Qualified tag names, built once rather than per parsed element
+CELL_TAG = MAIN_NS + "c"
+ROW_TAG = MAIN_NS + "row"
+VALUE_TAG = MAIN_NS + "v"
+INLINE_STRING_TAG = MAIN_NS + "is"
+SHARED_STRING_TAG = MAIN_NS + "si"
+TEXT_TAG = MAIN_NS + "t"
+RUN_TAG = MAIN_NS + "r"
+NUM_FMT_TAG = MAIN_NS + "numFmt"
+
+# (row, column) of every cell convert_excel needs: B1-B3 and B8-B11
+WANTED_CELLS = frozenset({(1, 2), (2, 2), (3, 2), (8, 2), (9, 2), (10, 2), (11, 2)})
+
+# Thousands separators and padding removed from numeric strings in one pass
+STRIP_TABLE = str.maketrans("", "", ", \t")
+
+# The two output files are written in parallel; os.write releases the GIL
+IO_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="converter-io")
+
+# Output directories opened as O_DIRECTORY fds so files are created relative to them (openat)
+SUPPORTS_DIR_FD = os.open in os.supports_dir_fd and hasattr(os, "O_DIRECTORY")
+DIRFD_CACHE = OrderedDict()
+DIRFD_CACHE_SIZE = 128
+DIRFD_LOCK = threading.Lock()
+
+TAXPNL_KEY = "Taxpnl Statement for Equity from 2024-04-01 to 2025-03-31"
+
+# cg_output.json never changes, so it is encoded once at import
+CG_OUTPUT_BYTES = orjson.dumps({"capitalGain": [], "profitLossACIncomes": []}, option=orjson.OPT_INDENT_2)
 
 def num(val):
-    try:
-        if val is None:
+    # Numeric cells arrive as float/int, so check those by exact type before anything else
+    val_type = type(val)
+    if val_type is float:
+        return val
+    if val_type is int:
+        try:
+            return float(val)
+        except OverflowError:
             return 0.0
-        if isinstance(val, str):
-            return float(val.replace(",", "").strip())
-        return float(val)
-    except:
+    if val is None:
         return 0.0
+    # try_float parses in C and reports failures as 0.0 instead of raising; float() accepts "1_000" too
+    if val_type is str:
+        val = val.translate(STRIP_TABLE)
+    return try_float(val, on_fail=0.0, on_type_error=0.0, allow_underscores=True)
+
+
+class UnsupportedLayout(Exception):
+    # Workbook XML the streaming reader does not handle; read_cells passes it to calamine instead
+    pass
+
+
+class MappedFile(mmap.mmap):
+    # zipfile calls seekable(), which mmap objects only have from Python 3.13
+    def seekable(self):
+        return True
+
+
+def cell_reference(row, col):
+    letters = ""
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return f"{letters}{row}"
+
+
+def workbook_parts(z):
+    # Resolve the active sheet (as openpyxl's wb.active), shared strings and styles through the
+    # workbook relationships, plus the date epoch serial dates count from
+    workbook = ElementTree.fromstring(z.read("xl/workbook.xml"))
+    view = workbook.find(f"{MAIN_NS}bookViews/{MAIN_NS}workbookView")
+    active = int(view.get("activeTab", 0)) if view is not None else 0
+    sheets = workbook.findall(f"{MAIN_NS}sheets/{MAIN_NS}sheet")
+    if not sheets:
+        # e.g. strict OOXML, whose elements live in a different namespace
+        raise UnsupportedLayout("no sheets in the transitional namespace")
+    sheet = sheets[active] if active < len(sheets) else sheets[0]
+    sheet_name, sheet_rid = sheet.get("name"), sheet.get(f"{REL_NS}id")
+    properties = workbook.find(f"{MAIN_NS}workbookPr")
+    date1904 = properties is not None and properties.get("date1904") in ("1", "true")
+    epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+    sheet_path = strings_path = styles_path = None
+    rels = ElementTree.fromstring(z.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.iter(f"{PKG_REL_NS}Relationship"):
+        target = rel.get("Target")
+        target = target[1:] if target.startswith("/") else "xl/" + target
+        if rel.get("Id") == sheet_rid:
+            sheet_path = target
+        elif rel.get("Type").endswith("/sharedStrings"):
+            strings_path = target
+        elif rel.get("Type").endswith("/styles"):
+            styles_path = target
+    if sheet_path is None:
+        raise KeyError(sheet_rid)
+    return sheet_name, sheet_path, strings_path, styles_path, epoch
+
+
+def style_formats(z, styles_path):
+    # Number format code of every cellXfs entry, indexed by a cell's s="" style id
+    styles = ElementTree.fromstring(z.read(styles_path))
+    custom = {int(fmt.get("numFmtId")): fmt.get("formatCode") for fmt in styles.iter(NUM_FMT_TAG)}
+    xfs = styles.find(f"{MAIN_NS}cellXfs")
+    if xfs is None:
+        return []
+    formats = []
+    for xf in xfs:
+        fmt_id = int(xf.get("numFmtId", 0))
+        formats.append(custom.get(fmt_id, BUILTIN_FORMATS.get(fmt_id)))
+    return formats
+
+
+def excel_date(value, fmt, epoch):
+    # Same conversion and out-of-range handling as openpyxl's reader
+    try:
+        return from_excel(value, epoch, timedelta=is_timedelta_format(fmt))
+    except (OverflowError, ValueError):
+        return "#VALUE!"
+
+
+def inline_text(elem):
+    # Plain <t> or rich-text runs <r><t>; phonetic runs are skipped like openpyxl does
+    t = elem.find(TEXT_TAG)
+    if t is not None:
+        return t.text or ""
+    return "".join(run.findtext(TEXT_TAG, "") for run in elem.iter(RUN_TAG))
+
 
+def read_cells_streaming(z, parts, wanted):
+    # Stream the active sheet's XML and stop after the last wanted row, without building a workbook.
+    # Cells are matched on their literal "B9"-style reference, so other cells are skipped unparsed.
+    _, sheet_path, strings_path, styles_path, epoch = parts
+    last_row = max(row for row, _ in wanted)
+    wanted_refs = {cell_reference(row, col): (row, col) for row, col in wanted}
+    values = {}
+    shared_refs = {}
+    styled_refs = {}
+    with z.open(sheet_path) as f:
+        for _, elem in ElementTree.iterparse(f, events=("end",)):
+            tag = elem.tag
+            if tag == CELL_TAG:
+                ref = elem.get("r")
+                if ref is None:
+                    raise UnsupportedLayout("cell without a reference")
+                key = wanted_refs.get(ref)
+                if key is None:
+                    continue
+                cell_type = elem.get("t", "n")
+                raw = elem.findtext(VALUE_TAG)
+                if cell_type == "inlineStr":
+                    is_elem = elem.find(INLINE_STRING_TAG)
+                    values[key] = inline_text(is_elem) if is_elem is not None else None
+                elif not raw:
+                    # No cached value, e.g. <v></v> on a formula that was never calculated
+                    values[key] = None
+                elif cell_type == "s":
+                    shared_refs[key] = int(raw)
+                elif cell_type in ("str", "e"):
+                    values[key] = raw
+                elif cell_type == "b":
+                    values[key] = raw == "1"
+                elif cell_type == "d":
+                    values[key] = from_ISO8601(raw)
+                else:
+                    if "." in raw or "E" in raw or "e" in raw:
+                        values[key] = float(raw)
+                    else:
+                        values[key] = int(raw)
+                    # Styled numbers may be dates; their formats are checked once the sheet is read
+                    style_id = int(elem.get("s", 0))
+                    if style_id:
+                        styled_refs[key] = style_id
+            elif tag == ROW_TAG:
+                row_ref = elem.get("r")
+                if row_ref is None:
+                    raise UnsupportedLayout("row without a reference")
+                if int(row_ref) >= last_row:
+                    break
+                elem.clear()
 
-def convert_excel(input_excel, output_dir):
-    wb = load_workbook(input_excel, data_only=True, read_only=True)
-    sheet = wb.active
+    if shared_refs:
+        if strings_path is None:
+            raise KeyError("xl/sharedStrings.xml")
+        needed = set(shared_refs.values())
+        last_needed = max(needed)
+        strings = {}
+        with z.open(strings_path) as f:
+            index = 0
+            for _, elem in ElementTree.iterparse(f, events=("end",)):
+                if elem.tag != SHARED_STRING_TAG:
+                    continue
+                if index in needed:
+                    strings[index] = inline_text(elem)
+                if index == last_needed:
+                    break
+                index += 1
+                elem.clear()
+        for key, index in shared_refs.items():
+            values[key] = strings[index]
 
-    def cell(r, c):
-        return sheet.cell(row=r, column=c).value
+    if styled_refs and styles_path is not None:
+        formats = style_formats(z, styles_path)
+        for key, style_id in styled_refs.items():
+            fmt = formats[style_id] if style_id < len(formats) else None
+            if is_date_format(fmt):
+                values[key] = excel_date(values[key], fmt, epoch)
 
-    example = {
-        "Client ID": cell(1, 2),
-        "Client Name": cell(2, 2),
-        "PAN": cell(3, 2),
-        "Taxpnl Statement for Equity from 2024-04-01 to 2025-03-31": [
+    return values
+
+
+def read_cells_calamine(input_excel, wanted, sheet_name=None):
+    wb = CalamineWorkbook.from_path(input_excel)
+    sheet = wb.get_sheet_by_index(0) if sheet_name is None else wb.get_sheet_by_name(sheet_name)
+    # skip_empty_area=False keeps rows/columns anchored at A1; nrows stops at the last wanted row
+    last_row = max(row for row, _ in wanted)
+    rows = sheet.to_python(skip_empty_area=False, nrows=last_row)
+    # Release the workbook's file handle and buffers before the values are used
+    wb.close()
+    del wb
+    values = {}
+    for row, col in wanted:
+        try:
+            value = rows[row - 1][col - 1]
+        except IndexError:
+            continue
+        if value == "":
+            value = None
+        elif type(value) is float and value.is_integer():
+            # calamine reports every number as float; openpyxl gives whole numbers back as int
+            value = int(value)
+        values[(row, col)] = value
+    return values
+
+
+def read_cells(input_excel, wanted):
+    sheet_name = None
+    try:
+        # Map the file instead of reading it into memory; the zip reader only touches the parts it needs
+        with open(input_excel, "rb") as excel_file, \
+                MappedFile(excel_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+                zipfile.ZipFile(mapped) as z:
+            parts = workbook_parts(z)
+            sheet_name = parts[0]
+            return read_cells_streaming(z, parts, wanted)
+    except (zipfile.BadZipFile, KeyError, UnsupportedLayout):
+        # Not a plain xlsx/xlsm layout (e.g. xls, xlsb, strict OOXML, cells without refs).
+        # calamine reads the sheet already resolved as active, or the first sheet if none was.
+        return read_cells_calamine(input_excel, wanted, sheet_name)
+
+
+@functools.lru_cache(maxsize=128)
+def output_paths(output_dir):
+    return os.path.join(output_dir, "example.json"), os.path.join(output_dir, "cg_output.json")
+
+
+def directory_fd(path):
+    # Reopen if the cached directory has since been deleted, so writes never land in an unlinked dir.
+    # Callers get their own dup, so an eviction closing the cached fd cannot pull it out from under them.
+    with DIRFD_LOCK:
+        fd = DIRFD_CACHE.get(path)
+        if fd is not None and os.fstat(fd).st_nlink == 0:
+            os.close(DIRFD_CACHE.pop(path))
+            fd = None
+        if fd is None:
+            fd = DIRFD_CACHE[path] = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            if len(DIRFD_CACHE) > DIRFD_CACHE_SIZE:
+                os.close(DIRFD_CACHE.popitem(last=False)[1])
+        else:
+            DIRFD_CACHE.move_to_end(path)
+        return os.dup(fd)
+
+
+def write_bytes(path, data, dir_fd=None):
+    # Unbuffered one-shot write; os.write may write less than asked, so loop until done
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644, dir_fd=dir_fd)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def wait_for_writes(writes, dir_fd):
+    # The directory fd is only closed once both writes have finished with it
+    try:
+        for write in writes:
+            write.result()
+    finally:
+        if dir_fd is not None:
+            wait(writes)
+            os.close(dir_fd)
+
+
+def build_example(client_id, client_name, pan, intraday, short_term, long_term, non_equity):
+    return {
+        "Client ID": client_id,
+        "Client Name": client_name,
+        "PAN": pan,
+        TAXPNL_KEY: [
             {
                 "Realized Profit Breakdown": {
-                    "Intraday/Speculative profit": num(cell(8, 2)),
-                    "Short Term profit": num(cell(9, 2)),
-                    "Long Term profit": num(cell(10, 2)),
-                    "Non Equity profit": num(cell(11, 2)),
+                    "Intraday/Speculative profit": intraday,
+                    "Short Term profit": short_term,
+                    "Long Term profit": long_term,
+                    "Non Equity profit": non_equity,
                 }
             }
         ]
     }
 
-    example_path = os.path.join(output_dir, "example.json")
-    with open(example_path, "w") as f:
-        json.dump(example, f, indent=4)
+
+def convert_excel(input_excel, output_dir, *, write_files=True, return_dicts=True):
+    # write_files=False only builds the dicts; return_dicts=False only writes the files and returns (None, None)
+    cells = read_cells(input_excel, WANTED_CELLS)
+
+    example = build_example(
+        cells.get((1, 2)),
+        cells.get((2, 2)),
+        cells.get((3, 2)),
+        num(cells.get((8, 2))),
+        num(cells.get((9, 2))),
+        num(cells.get((10, 2))),
+        num(cells.get((11, 2))),
+    )
+
+    writes = ()
+    dir_fd = None
+    if write_files:
+        # Encode before taking a directory fd, so an unencodable value cannot leak it
+        example_bytes = orjson.dumps(example, option=orjson.OPT_INDENT_2)
+        output_dir = os.fspath(output_dir)
+        if SUPPORTS_DIR_FD:
+            dir_fd = directory_fd(output_dir)
+            example_path, cg_path = "example.json", "cg_output.json"
+        else:
+            example_path, cg_path = output_paths(output_dir)
+        writes = (
+            IO_POOL.submit(write_bytes, example_path, example_bytes, dir_fd),
+            IO_POOL.submit(write_bytes, cg_path, CG_OUTPUT_BYTES, dir_fd),
+        )
+
+    if not return_dicts:
+        # Only the encoded bytes need to stay alive while the writes finish
+        del example
+        wait_for_writes(writes, dir_fd)
+        return None, None
 
     cg_output = {
         "capitalGain": [],
         "profitLossACIncomes": []
     }
 
-    cg_path = os.path.join(output_dir, "cg_output.json")
-    with open(cg_path, "w") as f:
-        json.dump(cg_output, f, indent=4)
-
-    wb.close()
+    wait_for_writes(writes, dir_fd)
 
     return example, cg_output